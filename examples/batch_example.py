@@ -16,43 +16,43 @@ __author__ = "Joshua Bocarsly, Matthew Evans"
 #                        UTILITY FUNCTIONS                           #
 ######################################################################
 
-def hotairup(Ttemp, logfh):
-    """Ramp hot air blower up to Ttemp target, writing the results to the log file handler."""
+# File number and temperature of each scan in the VT log files
+SCAN_LOG_LINE = '%d %s\n'
+
+def hotair_ramp(Ttemp, logfh, reached):
+    """Set the hot air blower to Ttemp and scan until `reached(temp)` is true, followed by
+    5 final scans, writing the results to the log file handler."""
     caput("BL11I-EA-BLOW-02:LOOP1:SP",Ttemp)
+    final_scans = 0
     for i in range(1000):
         scan delta 2 2.25 0.25 smythen 6
         temp = csb2.currentTemperature
-        line = str(long(beamline.getFileNumber())) + ' ' + str(temp) + '\n'    
-        logfh.write(line)
+        logfh.write(SCAN_LOG_LINE % (beamline.getFileNumber(), temp))
+        # Flush after every scan so the file number <-> temperature record survives a GDA crash
         logfh.flush()
-        if csb2.currentTemperature > Ttemp - 0.5 :
-            for j in range(5):
-                print "last 5 scans"
-                scan delta 2 2.25 0.25 smythen 6
-                temp = csb2.currentTemperature
-                line = str(long(beamline.getFileNumber())) + ' ' + str(temp) + '\n'    
-                logfh.write(line)
-                logfh.flush()
-            break
+        if final_scans:
+            final_scans += 1
+            if final_scans > 5:
+                break
+        elif reached(temp):
+            print "last 5 scans"
+            final_scans = 1
+
+def hotairup(Ttemp, logfh):
+    """Ramp hot air blower up to Ttemp target, writing the results to the log file handler."""
+    hotair_ramp(Ttemp, logfh, lambda temp: temp > Ttemp - 0.5)
 
 def hotairdown(Ttemp, logfh):
     """Ramp hot air blower down to Ttemp target, writing the results to the log file handler."""
-    caput("BL11I-EA-BLOW-02:LOOP1:SP",Ttemp)
-    for i in range(1000):
-        scan delta 2 2.25 0.25 smythen 6
-        temp = csb2.currentTemperature
-        line = str(long(beamline.getFileNumber())) + ' ' + str(temp) + '\n'    
-        logfh.write(line)
-        logfh.flush()
-        if csb2.currentTemperature < Ttemp + 1 :
-            for j in range(5):
-                print "last 5 scans"
-                scan delta 2 2.25 0.25 smythen 6
-                temp = csb2.currentTemperature
-                line = str(long(beamline.getFileNumber())) + ' ' + str(temp) + '\n'    
-                logfh.write(line)
-                logfh.flush()
-            break
+    hotair_ramp(Ttemp, logfh, lambda temp: temp < Ttemp + 1)
+
+def load_batch_csv(csv_filepath):
+    """Read the batch CSV file into a list of (position, sample_id, exposure, spos) tuples,
+    skipping the header row."""
+    with open(csv_filepath, 'r') as csvfile:
+        rowreader = csv.reader(csvfile)
+        next(rowreader)
+        return [(int(row[0]), row[1], float(row[2]), float(row[3])) for row in rowreader]
 
 ############################################################################################################
            
@@ -69,137 +69,75 @@ sample.start()
 # Turn on the spinner
 spin.on()
 
-# Open the log file in append mode (replace the path with the corre
 experiment_number = "cy28349-9"
 
-fh = open('/dls/i11/data/2022/cy28349-9/processing/Grey_BAG_31Mar22.log','a')
-
-print('Grey Sample start')
-print('starting PSD scans')
-
 # The CSV file that contains the list of samples to process in this run
 # This should be copied to the relevant directory on the DLS filesytem
 # The csv file can be found in the same directory as this script, if you are 
 # viewing it in the the-grey-group/dls-i11-tools repo on GitHub
 csv_filepath = '/dls/i11/data/2022/cy28349-9/processing/PSD_RT_MainBatch.csv'
 
-fh.write('running PSD scans at room temp from %s:\n', csv_filepath)
-fh.flush()
-
-with open(csv_filepath, 'r') as csvfile:
-    rowreader = csv.reader(csvfile)
-    for count, row in enumerate(rowreader):
-        # Skip header row
-        if count > 0:
-            # if row[0][0] == '#': continue
-            position = int(row[0])
-            sample_id = row[1]
-            time = float(row[2])
-            samplepos = float(row[3])
-
-            # Select the sample in <position> in the carousel
-            pos sample position
-            # Some capillaries might be shorter than others (especially if a dumb theorist is the one who packed them, *ahem*).
-            # `spos` can be adjusted to align the capillary with the beam, as a column in the CSV file.
-            # Warning: in March, this number could be in the range 0-5, but setting `spos` to 5 will crash GDA (it is a hard upper limit).
-            # Using 4.9 would work.
-            pos spos samplepos
-            scan delta 2 2.25 0.25 smythen time
-            fh.write('{} {} {} {} seconds PSD scan at room temperature, spos = {} mm, {} \n'.format(
-                long(beamline.getFileNumber()), 
-                sample_id, 
-                position, 
-                2*time,
-                samplepos,
-                datetime.datetime.now())
-            )
-            fh.flush()
-            sleep(2)
-
-sample.clearSample()
-
-
 # run VT heating scans on some particular samples (here, 50, then 10, 11, 12 and 13)
-fh.write('Running VT TEST on CC LNO-2\n')
-fh.write('\tsample placed into HAB at 30C, and start ramping to 40 C\n')
-fh.write('\tsee log file: CCLNO_heating_test.log\n')
-fh.flush()
-
-setSubdirectory('CCLNO_heating_test.log')
-logfh = open('/dls/i11/data/2022/cy28349-9/processing/CCLNO_heating_test.log','a')
-pos sample 50
-pos tlx 0
-caput("BL11I-EA-BLOW-02:LOOP1:RR", 0.2) #ramp rate ~12 deg/min
-hotairup(40, logfh) # measure from 30 C to 600 C
-hotairdown(30, logfh) # measure from 30 C to 600 C
-logfh.close()
-pos tlx 300
-
-fh.write('Running VT on FHTO1\n')
-fh.write('\tsample placed into HAB at 30C, and start ramping to 600 C\n')
-fh.write('\tsee log file: FHT01_heating.log\n')
-fh.flush()
-
-setSubdirectory('FHT01_heating_30C-600C')
-logfh = open('/dls/i11/data/2022/cy28349-9/processing/FHT01_heating_30C_to_600C.log','a')
-pos sample 10
-pos tlx 0
-caput("BL11I-EA-BLOW-02:LOOP1:RR", 0.2) #ramp rate ~12 deg/min
-hotairup(600, logfh) # measure from 30 C to 600 C
-hotairdown(30, logfh) # measure from 30 C to 600 C
-logfh.close()
-pos tlx 300
-
-
-fh.write('Running VT on FHTO2\n')
-fh.write('\tsample placed into HAB at 30C, and start ramping to 600 C\n')
-fh.write('\tsee log file: FHT02_heating.log\n')
-fh.flush()
-
-setSubdirectory('FHT02_heating_30C-600C')
-logfh = open('/dls/i11/data/2022/cy28349-9/processing/FHT02_heating_30C_to_600C.log','a')
-pos sample 11
-pos tlx 0
-caput("BL11I-EA-BLOW-02:LOOP1:RR", 0.2) #ramp rate ~12 deg/min
-hotairup(600, logfh) # measure from 30 C to 600 C
-hotairdown(30, logfh) # measure from 30 C to 600 C
-logfh.close()
-pos tlx 300
-
-
-fh.write('Running VT on FHTO3\n')
-fh.write('\tsample placed into HAB at 30C, and start ramping to 600 C\n')
-fh.write('\tsee log file: FHT03_heating.log\n')
-fh.flush()
+# Each run is (label, sample position, subdirectory, log file, target temperature in C)
+vt_runs = [
+    ('TEST on CC LNO-2', 50, 'CCLNO_heating_test.log', 'CCLNO_heating_test.log', 40),
+    ('on FHT01', 10, 'FHT01_heating_30C-600C', 'FHT01_heating_30C_to_600C.log', 600),
+    ('on FHT02', 11, 'FHT02_heating_30C-600C', 'FHT02_heating_30C_to_600C.log', 600),
+    ('on FHT03', 12, 'FHT03_heating_30C-600C', 'FHT03_heating_30C_to_600C.log', 600),
+    ('on FHT04', 13, 'FHT04_heating_30C-600C', 'FHT04_heating_30C_to_600C.log', 600),
+]
 
-setSubdirectory('FHT01_heating_30C-600C')
-logfh = open('/dls/i11/data/2022/cy28349-9/processing/FHT03_heating_30C_to_600C.log','a')
-pos sample 12
-pos tlx 0
-caput("BL11I-EA-BLOW-02:LOOP1:RR", 0.2) #ramp rate ~12 deg/min
-hotairup(600, logfh) # measure from 30 C to 600 C
-hotairdown(30, logfh) # measure from 30 C to 600 C
-logfh.close()
-pos tlx 300
-
-
-
-
-fh.write('Running VT on FHTO4\n')
-fh.write('\tsample placed into HAB at 30C, and start ramping to 600 C\n')
-fh.write('\tsee log file: FHT04_heating.log\n')
-fh.flush()
-
-setSubdirectory('FHT04_heating_30C-600C')
-logfh = open('/dls/i11/data/2022/cy28349-9/processing/FHT04_heating_30C_to_600C.log','a')
-pos sample 13
-pos tlx 0
-caput("BL11I-EA-BLOW-02:LOOP1:RR", 0.2) #ramp rate ~12 deg/min
-hotairup(600, logfh) # measure from 30 C to 600 C
-hotairdown(30, logfh) # measure from 30 C to 600 C
-logfh.close()
-pos tlx 300
+# Open the log file in append mode (replace the path with the corre
+with open('/dls/i11/data/2022/cy28349-9/processing/Grey_BAG_31Mar22.log','a', 65536) as fh:
+    print('Grey Sample start')
+    print('starting PSD scans')
+
+    fh.write('running PSD scans at room temp from %s:\n' % csv_filepath)
+    fh.flush()
+
+    # Rows that repeat a sample reuse its formatted description in the log
+    row_descriptions = {}
+    now = datetime.datetime.now
+
+    for position, sample_id, exposure, samplepos in load_batch_csv(csv_filepath):
+        # Select the sample in <position> in the carousel
+        pos sample position
+        # Some capillaries might be shorter than others (especially if a dumb theorist is the one who packed them, *ahem*).
+        # `spos` can be adjusted to align the capillary with the beam, as a column in the CSV file.
+        # Warning: in March, this number could be in the range 0-5, but setting `spos` to 5 will crash GDA (it is a hard upper limit).
+        # Using 4.9 would work.
+        pos spos samplepos
+        scan delta 2 2.25 0.25 smythen exposure
+        row_key = (sample_id, position, exposure, samplepos)
+        description = row_descriptions.get(row_key)
+        if description is None:
+            description = row_descriptions[row_key] = '{} {} {} seconds PSD scan at room temperature, spos = {} mm'.format(
+                sample_id,
+                position,
+                2*exposure,
+                samplepos
+            )
+        fh.write('{} {}, {} \n'.format(long(beamline.getFileNumber()), description, now()))
+        # Flush after every scan so the file number <-> sample record survives a GDA crash
+        fh.flush()
+        sleep(2)
+
+    sample.clearSample()
+
+    for label, sample_position, subdirectory, log_name, target_temperature in vt_runs:
+        fh.write('Running VT %s\n' % label)
+        fh.write('\tsample placed into HAB at 30C, and start ramping to %s C\n' % target_temperature)
+        fh.write('\tsee log file: %s\n' % log_name)
+        fh.flush()
+
+        setSubdirectory(subdirectory)
+        with open('/dls/i11/data/2022/cy28349-9/processing/' + log_name, 'a', 65536) as logfh:
+            pos sample sample_position
+            pos tlx 0
+            caput("BL11I-EA-BLOW-02:LOOP1:RR", 0.2) #ramp rate ~12 deg/min
+            hotairup(target_temperature, logfh) # measure from 30 C to target
+            hotairdown(30, logfh) # measure from target back to 30 C
+        pos tlx 300
 
-fh.close()
 sample.clearSample()
 spin.off()     
\ No newline at end of file
@@ -22,54 +22,179 @@ __all__ = (
     "variable_temp_psd",
 )
 
+import atexit
 import datetime
 import logging
+import logging.handlers
+import os
 import time
 
 TESTING = True
 
 
+def _buffered_file_handler(filename, formatter, capacity=512):
+    """Returns a handler that buffers up to `capacity` records in memory
+    before writing them to `filename`, so that logging from the scan loop
+    does not block on a disk write for every record. The buffer is flushed
+    immediately for warnings and errors, so that the records needed to
+    diagnose a crash reach the disk even if the exit hooks never run, and
+    at interpreter exit.
+
+    """
+    target = logging.FileHandler(filename, mode="a")
+    target.setFormatter(formatter)
+    handler = logging.handlers.MemoryHandler(
+        capacity, flushLevel=logging.WARNING, target=target
+    )
+    atexit.register(handler.close)
+    return handler
+
+
+_TODAY = str(datetime.date.today())
+
+# Loggers outlive a `reload` of this module, so handlers are only attached
+# the first time to avoid duplicate output and extra open log files
 LOG = logging.getLogger("root")
 LOG.setLevel(logging.DEBUG)
-LOG.addHandler(logging.FileHandler(str(datetime.date.today()) + ".log", mode="a"))
-LOG.addHandler(logging.StreamHandler())
-for handler in LOG.handlers:
-    handler.setFormatter(logging.Formatter("%(asctime)-15s %(levelname)-6s: %(message)s"))
-
+if not LOG.handlers:
+    _log_formatter = logging.Formatter("%(asctime)-15s %(levelname)-6s: %(message)s")
+    LOG.addHandler(_buffered_file_handler(_TODAY + ".log", _log_formatter))
+    LOG.addHandler(logging.StreamHandler())
+    LOG.handlers[-1].setFormatter(_log_formatter)
+
+# Records the file number, sample and temperature of each scan. This is only
+# written to file, to keep per-scan logging cheap, but is not buffered, so that
+# no scan records are lost if GDA crashes
 FILE_LOG = logging.getLogger("file")
-FILE_LOG.addHandler(logging.FileHandler(str(datetime.date.today()) + ".file.log", mode="a"))
 FILE_LOG.setLevel(logging.DEBUG)
-FILE_LOG.addHandler(logging.StreamHandler())
-for handler in FILE_LOG.handlers:
-    handler.setFormatter(logging.Formatter("%(message)s"))
+if not FILE_LOG.handlers:
+    FILE_LOG.addHandler(logging.FileHandler(_TODAY + ".file.log", mode="a"))
+    FILE_LOG.handlers[-1].setFormatter(logging.Formatter("%(message)s"))
 
 
 def temperature_reached(start_temperature, end_temperature, current_temperature):
-    if start_temperature < end_temperature and current_temperature >= end_temperature:
-        return True
-    if start_temperature > end_temperature and current_temperature <= end_temperature:
-        return True
-    return False
+    """Returns whether `current_temperature` has reached `end_temperature`
+    on a ramp from `start_temperature`. A ramp with no change in temperature
+    has trivially reached its end.
 
+    The end is reached when the current temperature is on the far side of
+    the end temperature in the direction of the ramp, i.e., when the ramp
+    direction and the remaining overshoot have the same sign.
 
-class _Singleton(object):
-    _instance = None
+    """
+    return (end_temperature - start_temperature) * (current_temperature - end_temperature) >= 0
 
-    def __new__(cls, *args, **kwargs):
-        if not cls._instance:
-            cls._instance = super(_Singleton, cls).__new__(
-                cls, *args, **kwargs
-            )
-        return cls._instance
+
+try:
+    # Jython (Python 2.7) has no `time.monotonic`, so use the JVM's monotonic clock
+    from java.lang import System as _System
+
+    def _clock():
+        return _System.nanoTime() / 1e9
+
+except ImportError:
+    _clock = getattr(time, "monotonic", time.time)
+
+
+class _Ticker(object):
+    """Sleeps until deadlines spaced `period` seconds apart, so that the
+    time spent between calls does not accumulate as drift in the cadence.
+    If a deadline has already been missed, the schedule restarts from
+    the current time rather than returning early repeatedly to catch up.
+    No single wait is longer than `period`, even if the clock jumps.
+
+    """
+
+    def __init__(self, period):
+        self.period = period
+        self._deadline = None
+
+    def __call__(self):
+        now = _clock()
+        if self._deadline is None:
+            self._deadline = now
+        self._deadline = min(max(self._deadline + self.period, now), now + self.period)
+        time.sleep(self._deadline - now)
+
+
+class _SingletonType(type):
+    """Metaclass that creates (and initialises) one instance per class,
+    returning that same instance on every subsequent call.
+
+    """
+
+    _instances = {}
+
+    def __call__(cls, *args, **kwargs):
+        instance = _SingletonType._instances.get(cls)
+        if instance is None:
+            instance = super(_SingletonType, cls).__call__(*args, **kwargs)
+            _SingletonType._instances[cls] = instance
+        return instance
+
+
+# Created by calling the metaclass directly, as the syntax for declaring
+# a metaclass differs between Python 2 and 3
+_Singleton = _SingletonType("_Singleton", (object,), {})
 
 class Beamline(_Singleton):
+    # File numbers are persisted here (relative to the directory at import,
+    # like the log files) so that a restarted session does not reuse them
+    file_number_path = os.path.abspath(".filenum")
+    # How many file numbers to reserve on disk at a time
+    file_number_reserve = 50
+
     def __init__(self):
-        self.file_number = 0
+        self.file_number = self._load_file_number()
+        self._reserved_file_number = None
 
     def getFileNumber(self):
         self.file_number += 1
+        if self._reserved_file_number is None:
+            # Only sessions that actually use file numbers write them back at exit
+            atexit.register(self._release_file_numbers)
+            self._reserved_file_number = 0
+        if self.file_number > self._reserved_file_number:
+            # Only write to disk once per block of numbers; if the session dies
+            # the next one resumes after the block, skipping any unused numbers
+            on_disk = self._load_file_number()
+            if on_disk > self._reserved_file_number:
+                # Another instance (e.g., one created before a `reload` of this
+                # module) has reserved numbers since, so continue after them
+                self.file_number = max(self.file_number, on_disk + 1)
+            self._reserved_file_number = self.file_number + self.file_number_reserve
+            self._save_file_number(self._reserved_file_number)
         return self.file_number
 
+    def _load_file_number(self):
+        try:
+            with open(self.file_number_path) as f:
+                contents = f.read()
+        except IOError:
+            return 0
+        try:
+            return int(contents)
+        except ValueError:
+            # Restarting from 0 would reuse file numbers, so refuse to guess
+            LOG.error("Could not read file number from %s: %r", self.file_number_path, contents)
+            raise
+
+    def _save_file_number(self, file_number):
+        # Write to a temporary file and rename it over the old one, so that
+        # a crash mid-write cannot leave a truncated file behind
+        tmp_path = self.file_number_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(file_number))
+        os.rename(tmp_path, self.file_number_path)
+
+    def _release_file_numbers(self):
+        """Hand the unused part of the reserved block back at exit, unless
+        another instance has reserved numbers since this one did.
+
+        """
+        if self._load_file_number() == self._reserved_file_number:
+            self._save_file_number(self.file_number)
+
 class Beam(_Singleton):
     def __init__(self):
         self._on = False
@@ -84,7 +209,7 @@ class Beam(_Singleton):
 class Table(_Singleton):
 
     def __call__(self, motor, position):
-        LOG.debug("Moving motor %s from %s to %s" % (motor, motor.position, position))
+        LOG.debug("Moving motor %s from %s to %s", motor, motor.position, position)
         motor.position = position
 
 
@@ -160,6 +285,9 @@ class Cryostream(_Singleton):
     _set_point = 21.0
     _ramp_rate = 0.0
     _ramp_start_time = None
+    _last_update_time = 0.0
+    # Minimum time in seconds between updates of the simulated temperature
+    _update_interval = 0.05
 
     @property
     def currentTemperature(self):
@@ -170,12 +298,18 @@ class Cryostream(_Singleton):
         if self._ramp_start_time is None:
             return self._current_temperature
 
+        now = time.time()
+        if now - self._last_update_time < self._update_interval:
+            return self._current_temperature
+        self._last_update_time = now
+
         if abs(self._current_temperature - self._set_point) < 1:
             self._current_temperature = self.set_point
             self._ramp_start_time = None
         else:
-            self._current_temperature += self.ramp_rate * (time.time() - self._ramp_start_time)
-        LOG.debug("🌡  Cryostream temperature is now %f °C" % self._current_temperature)
+            self._current_temperature += self.ramp_rate * (now - self._ramp_start_time)
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug("🌡  Cryostream temperature is now %f °C", self._current_temperature)
 
         return self._current_temperature
 
@@ -186,7 +320,7 @@ class Cryostream(_Singleton):
     @set_point.setter
     def set_point(self, value):
         LOG.debug("🌡  Setting Cryostream set point to %s °C", value)
-        caput("BL11I-EA-BLOW-02:LOOP1:SP", self._set_point)
+        caput("BL11I-EA-BLOW-02:LOOP1:SP", value)
         self._set_point = value
 
     @property
@@ -197,7 +331,7 @@ class Cryostream(_Singleton):
     def ramp_rate(self, value):
         """Ramp rate in degrees per second."""
         LOG.debug("🌡  Setting Cryostream ramp rate to %s K/s", value)
-        caput("BL11I-EA-BLOW-02:LOOP1:RR", self._ramp_rate)
+        caput("BL11I-EA-BLOW-02:LOOP1:RR", value)
         self._ramp_rate = value
 
     def start(self):
@@ -215,13 +349,34 @@ class Cryostream(_Singleton):
             raise RuntimeError("No ramp rate set")
 
 
+# Shared instances used by the scan helpers below
+_BEAMLINE = Beamline()
+_SAMPLES = Samples()
+_CRYOSTREAM = Cryostream()
+
+
 def setSubDirectory(path):
-    import os
     if not os.path.isdir(path):
         os.makedirs(path)
     os.chdir(path)
 
 
+_KNOWN_CAPUT_PARAMETERS = frozenset((
+    "BL11I-EA-BLOW-02:LOOP1:SP",  # air blower set point
+    "BL11I-EA-BLOW-02:LOOP1:RR",  # air blower ramp rate
+    "BL11I-CG-CSTRM-02:RRATE",  # cryostream ramp rate
+    "BL11I-CG-CSTRM-02:RTEMP",  # cryostream target temperature
+    "BL11I-CG-CSTRM-02:RAMP.PROC",  # start cryostream ramp
+))
+
+# Simulated effect of `caput` for each parameter. These set the Cryostream
+# attributes directly, as its property setters themselves call `caput`.
+_CAPUT_HANDLERS = {
+    "BL11I-EA-BLOW-02:LOOP1:SP": lambda value: setattr(_CRYOSTREAM, "_set_point", value),
+    "BL11I-EA-BLOW-02:LOOP1:RR": lambda value: setattr(_CRYOSTREAM, "_ramp_rate", value),
+}
+
+
 def caput(parameter, value=None):
     """Controls an instrument over EPICS via Channel Access (CA),
     hence `caput`.
@@ -235,25 +390,14 @@ def caput(parameter, value=None):
 
     """
 
-    known_parameters = (
-        "BL11I-EA-BLOW-02:LOOP1:SP",  # air blower set point
-        "BL11I-EA-BLOW-02:LOOP1:RR",  # air blower ramp rate
-        "BL11I-CG-CSTRM-02:RRATE",  # cryostream ramp rate
-        "BL11I-CG-CSTRM-02:RTEMP",  # cryostream target temperature
-        "BL11I-CG-CSTRM-02:RAMP.PROC"  # start cryostream ramp
-    )
-
-    if parameter not in known_parameters:
-        LOG.warn(
+    if parameter not in _KNOWN_CAPUT_PARAMETERS:
+        LOG.warning(
             "🖥️ Parameter %s not in known parameters for `caput`.", parameter
         )
 
-    #if parameter == "BL11I-EA-BLOW-02:LOOP1:SP":
-    #    csb2 = Cryostream()
-    #    csb2.set_point = value
-    #elif parameter == "BL11I-EA-BLOW-02:LOOP1:RR":
-    #    csb2 = Cryostream()
-    #    csb2.ramp_rate = value
+    handler = _CAPUT_HANDLERS.get(parameter)
+    if handler is not None:
+        handler(value)
 
     LOG.debug("🖥️  Executed caput with %s and value %s", parameter, value)
 
@@ -270,7 +414,7 @@ def variable_temp_psd(start_temperature, target_temperature, ramp_rate=0.2, max_
 
     """
 
-    csb2 = Cryostream()
+    csb2 = _CRYOSTREAM
 
     LOG.info(
         "🌡  Performing variable temperature PSD in range %s °C -> %s °C",
@@ -284,12 +428,17 @@ def variable_temp_psd(start_temperature, target_temperature, ramp_rate=0.2, max_
     csb2.ramp_rate = ramp_rate
     csb2.start()
 
-    while not temperature_reached(
-        initial_temperature,
-        start_temperature,
-        csb2.current_temperature
-    ):
-        time.sleep(1)
+    # Bind the polling lookups locally, as they are evaluated on every iteration
+    reached = temperature_reached
+    current_temperature = type(csb2).current_temperature.fget
+
+    # Sleep through most of the predicted ramp time rather than waking
+    # every second, then poll until the start temperature is confirmed
+    eta = abs(start_temperature - initial_temperature) / float(abs(ramp_rate))
+    time.sleep(0.95 * eta)
+    tick = _Ticker(1.0)
+    while not reached(initial_temperature, start_temperature, current_temperature(csb2)):
+        tick()
 
     LOG.info(
         "🌡  Cryostream reached %s °C. Beginning ramp up to %s °C",
@@ -303,11 +452,7 @@ def variable_temp_psd(start_temperature, target_temperature, ramp_rate=0.2, max_
     csb2.start()
 
     counter = 0
-    while not temperature_reached(
-        start_temperature,
-        target_temperature,
-        csb2.current_temperature
-    ):
+    while not reached(start_temperature, target_temperature, current_temperature(csb2)):
         counter += 1
         psd_scan(2, 2.25, 0.25, 6)
 
@@ -334,13 +479,11 @@ def psd_scan(start, stop, step, exposure_time, detector_name="smythen", _sleep=0
         else:
             LOG.error("Syntax error in scan command: %s", exc)
 
-    beamline = Beamline()
-    samples = Samples()
-    csb2 = Cryostream()
-
-    FILE_LOG.info(
-        "%s %s %s",
-        str(long(beamline.getFileNumber())),
-        samples.sample_in_position,
-        csb2.current_temperature
-    )
\ No newline at end of file
+    file_number = _BEAMLINE.getFileNumber()
+    if FILE_LOG.isEnabledFor(logging.INFO):
+        FILE_LOG.info(
+            "%d %s %f",
+            file_number,
+            _SAMPLES.sample_in_position,
+            _CRYOSTREAM.current_temperature
+        )